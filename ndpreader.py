@@ -1,8 +1,166 @@
 import os
-from types import SimpleNamespace
-import xml.etree.ElementTree as ET
+import math
+import sys
+import hashlib
+import pickle
+from dataclasses import dataclass, fields
+from functools import cached_property, lru_cache
+import numpy as np
+try:
+    from lxml import etree as ET
+    _LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _LXML = False
 import tifffile
 
+# NDPI tags used by NDPReader, the Hamamatsu specific ones are looked up by code
+_IMAGE_DETAIL_TAGS = {
+    'ImageWidth': 'ImageWidth',
+    'ImageLength': 'ImageLength',
+    'XResolution': 'XResolution',
+    'YResolution': 'YResolution',
+    'DateTime': 'DateTime',
+    'Make': 'Make',
+    'Model': 'Model',
+    'Software': 'Software',
+    'XOffsetFromSlideCenter': 65422,
+    'YOffsetFromSlideCenter': 65423,
+    'ZOffsetFromSlideCenter': 65424,
+}
+
+# smallest batch of points converted with the Numba kernel (when enabled),
+# below this NumPy is already fast enough and the kernel dispatch isn't worth it
+_NUMBA_MIN_POINTS = 100_000
+
+
+@lru_cache(maxsize=None)
+def _get_affine2d():
+    """
+    Returns the Numba kernel writing points * (sx, sy) + (bx, by) into out for
+    an (N, 2) array of points, or None if Numba isn't installed.
+
+    Numba is imported and the kernel compiled on the first call only, so
+    importing this module doesn't pay for it.
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    # only allow contracting into fused multiply-adds, NaNs must stay NaNs
+    @njit(parallel=True, cache=True, fastmath={'contract'})
+    def affine2d(points, sx, sy, bx, by, out):
+        for i in prange(points.shape[0]):
+            out[i, 0] = points[i, 0] * sx + bx
+            out[i, 1] = points[i, 1] * sy + by
+
+    return affine2d
+
+
+# bumped whenever the layout of the cached objects changes
+_CACHE_VERSION = 5
+
+
+def _flag(element):
+    """
+    Returns True if the flag element is present and set to "1".
+    """
+    return element is not None and element.text == "1"
+
+
+def _intern(text):
+    """
+    Returns the interned text, or None for an empty element.
+    """
+    return sys.intern(text) if text is not None else None
+
+
+def _cache_path(cache_dir, name, *paths):
+    """
+    Returns the path of the cache file for the given files, keyed by their absolute paths.
+    """
+    key = hashlib.sha1("|".join(os.path.abspath(path) for path in paths).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{name}-{key}.pickle")
+
+
+def _cache_signature(*paths):
+    """
+    Returns the cache version with the modification time and size of the given files.
+
+    The signature is stored in the cache file and compared on load, so a changed
+    file overwrites its own cache entry instead of leaving a stale one behind.
+    """
+    signature = [_CACHE_VERSION]
+    for path in paths:
+        stat = os.stat(path)
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _load_cache(cache_path, signature):
+    """
+    Returns the object pickled in the cache file, or None if it can't be read
+    or was stored for a different signature.
+
+    Any error is treated as a cache miss: besides missing or corrupt files,
+    unpickling can fail in many ways (e.g. a class that moved or changed),
+    and a bad cache entry must never make a valid file unreadable.
+    """
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_signature, obj = pickle.load(f)
+    except Exception:
+        return None
+    return obj if cached_signature == signature else None
+
+
+def _dump_cache(cache_path, signature, obj):
+    """
+    Pickles the object and its signature into the cache file, failing silently if it can't be written.
+    """
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((signature, obj), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # don't leave a partial file behind, e.g. when the disk is full
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+@dataclass(slots=True)
+class Annotation:
+    """
+    An annotation parsed from an NDPA file, with its coordinates in pixels.
+
+    x, y and z are None for linear measures, radius is None when not given
+    and points is None for annotations without points.
+    """
+    title: str
+    details: str
+    coordformat: str | None
+    showtitle: bool
+    showhistogram: bool
+    showlineprofile: bool
+    type: str
+    displayname: str
+    color: str
+    measuretype: str | None
+    closed: bool
+    lens: float | None = None
+    x: float | None = None
+    y: float | None = None
+    z: float | None = None
+    radius: float | None = None
+    points: list | None = None
+    xml_type: str = 'ndpviewstate'
+
+
 class NDPReader(object):
     """
     Class for reading NDPI files and associated annotations (NDPA files).
@@ -10,7 +168,7 @@ class NDPReader(object):
     Attributes:
         ndpi_path (str): The path to the NDPI file.
         ndpa_path (str): The path to the associated NDPA file.
-        slide_properties (dict): Metadata properties extracted from the NDPI file.
+        slide_properties (dict): Metadata properties extracted from the NDPI file (read on first access).
         size_x (int): The width of the slide in pixels.
         size_y (int): The height of the slide in pixels.
         mpp_x (float): Microns per pixel in the x-direction.
@@ -21,7 +179,16 @@ class NDPReader(object):
         offset_from_centre_y (float): The y-offset from the slide's center in nanometers.
         offset_x (float): The x-coordinate offset to the slide's top-left corner in nanometers.
         offset_y (float): The y-coordinate offset to the slide's top-left corner in nanometers.
-        annotations (list): A list of parsed annotations from the NDPA file.
+        annotations (list): A list of Annotation objects parsed from the NDPA file.
+        xs (numpy.ndarray): The x-coordinate of each annotation in pixels (NaN for linear measures).
+        ys (numpy.ndarray): The y-coordinate of each annotation in pixels (NaN for linear measures).
+        zs (numpy.ndarray): The z-coordinate of each annotation (NaN for linear measures).
+        lenses (numpy.ndarray): The lens (magnification) of each annotation.
+        radii (numpy.ndarray): The radius of each annotation (NaN when not given).
+        closed_mask (numpy.ndarray): Whether each annotation is closed.
+        points_flat (numpy.ndarray): The (N, 2) points of all annotations in pixels.
+        points_offsets (numpy.ndarray): Offsets into points_flat, the points of annotation i
+            are points_flat[points_offsets[i]:points_offsets[i+1]].
 
     Methods:
         __init__(self, ndpi_path, ndpa_path=None):
@@ -36,9 +203,32 @@ class NDPReader(object):
         nm_to_pixel(self, point):
             Converts a point in nanometers to micrometer pixel coordinates.
 
+        nm_to_pixel_batch(self, points):
+            Converts an array of points in nanometers to micrometer pixel coordinates.
+
+        _iter_ndpviewstates(self):
+            Yields the view state elements of the NDPA file as they are parsed.
+
         _parse_annotations(self):
             Parses annotations from the NDPA file.
+
+        _link_annotation_points(self):
+            Sets the points of each annotation from points_flat.
     """
+
+    # convert large point batches with the Numba kernel, off by default as
+    # importing Numba and loading the kernel costs more than it saves for
+    # typical NDPA files
+    _use_numba = False
+    # directory where the NDPI metadata is cached, None disables the cache
+    _metadata_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "ndpreader")
+    # directory where the parsed annotations are cached, None (the default)
+    # disables the cache, e.g. set it to _metadata_cache_dir to enable it
+    _annotation_cache_dir = None
+    # arrays set by _parse_annotations, stored in the annotation cache next to
+    # the annotations (which are stored as tuples of their fields)
+    _annotation_arrays = ('xs', 'ys', 'zs', 'lenses', 'radii', 'closed_mask',
+                          'points_flat', 'points_offsets')
     
     
     def __init__(self, ndpi_path:str, ndpa_path:str = None):
@@ -82,46 +272,80 @@ class NDPReader(object):
             "Image Filename": os.path.basename(self.ndpi_path),
             "Annotation Filename": os.path.basename(self.ndpa_path),
             "Dimensions": (self.size_x,self.size_y),
-            "Date":self.slide_properties['DateTime'],
-            "Maker":self.slide_properties['Make'],
-            "Model":self.slide_properties['Model'],
-            "Software":self.slide_properties['Software'],
+            "Date":self._image_details['DateTime'],
+            "Maker":self._image_details['Make'],
+            "Model":self._image_details['Model'],
+            "Software":self._image_details['Software'],
             "Annotations": len(self.annotations),
         }
 
 
-    def _parse_image_detais(self):
+    @cached_property
+    def slide_properties(self):
         """
-        Parses image details from the NDPI file.
+        Metadata properties extracted from the NDPI file, read on first access.
         """
         with tifffile.TiffFile(self.ndpi_path) as tif:
             # get most tags
-            self.slide_properties = {tag.name:tag.value for tag in tif.pages[0].tags}
+            slide_properties = {tag.name:tag.value for tag in tif.pages[0].tags}
             # get custom ndpi tags
             for key,value in tif.pages[0].ndpi_tags.items():
-                self.slide_properties[key] = value
+                slide_properties[key] = value
+        return slide_properties
+
+
+    def _parse_image_detais(self):
+        """
+        Parses image details from the NDPI file.
+
+        Only the tags used by the reader are read, the complete metadata is
+        available through slide_properties. The image details are cached on
+        disk (see _metadata_cache_dir) so reading the same NDPI file again
+        doesn't need to open it.
+        """
+        cache_path = None
+        self._image_details = None
+        if self._metadata_cache_dir is not None:
+            cache_path = _cache_path(self._metadata_cache_dir, "metadata", self.ndpi_path)
+            signature = _cache_signature(self.ndpi_path)
+            self._image_details = _load_cache(cache_path, signature)
+
+        if self._image_details is None:
+            with tifffile.TiffFile(self.ndpi_path) as tif:
+                tags = tif.pages[0].tags
+                self._image_details = {name: tags.valueof(key) for name, key in _IMAGE_DETAIL_TAGS.items()}
+            if cache_path is not None:
+                _dump_cache(cache_path, signature, self._image_details)
         
         # get slide size 
-        self.size_x = self.slide_properties['ImageWidth']
-        self.size_y = self.slide_properties['ImageLength']
+        self.size_x = self._image_details['ImageWidth']
+        self.size_y = self._image_details['ImageLength']
         
         # microns per pixel (mpp) (resolution scale cm to um)
-        self.mpp_x = 10000 / self.slide_properties['XResolution'][0]
-        self.mpp_y = 10000 / self.slide_properties['YResolution'][0]
+        self.mpp_x = 10000 / self._image_details['XResolution'][0]
+        self.mpp_y = 10000 / self._image_details['YResolution'][0]
 
         # calculate centere from pixels to nanometers
         self.centre_x = self.size_x * self.mpp_x * 1000 / 2
         self.centre_y = self.size_y * self.mpp_y * 1000 / 2
         
         # get offset from metadata (in nm)
-        self.offset_from_centre_x = self.slide_properties['XOffsetFromSlideCenter']
-        self.offset_from_centre_y = self.slide_properties['YOffsetFromSlideCenter']
-        self.offset_from_centre_z = self.slide_properties['ZOffsetFromSlideCenter']
+        self.offset_from_centre_x = self._image_details['XOffsetFromSlideCenter']
+        self.offset_from_centre_y = self._image_details['YOffsetFromSlideCenter']
+        self.offset_from_centre_z = self._image_details['ZOffsetFromSlideCenter']
 
         # translate from center to top left
         self.offset_x = self.centre_x - self.offset_from_centre_x
         self.offset_y = self.centre_y - self.offset_from_centre_y
 
+        # nm to pixel conversion as a single multiply-add: x * scale + bias
+        self._sx = 1 / (1000 * self.mpp_x)
+        self._sy = 1 / (1000 * self.mpp_y)
+        self._bx = self.offset_x * self._sx
+        self._by = self.offset_y * self._sy
+        self._scale = np.array([self._sx, self._sy])
+        self._bias = np.array([self._bx, self._by])
+
 
     def nm_to_pixel(self, point):
         """
@@ -133,65 +357,200 @@ class NDPReader(object):
         Returns:
             list: A list containing x and y coordinates in micrometer pixel units.
         """
-        x = (point[0] + self.offset_x) / (1000 * self.mpp_x)
-        y = (point[1] + self.offset_y) / (1000 * self.mpp_y)
-        return [x,y]
+        return [point[0] * self._sx + self._bx, point[1] * self._sy + self._by]
+
+
+    def nm_to_pixel_batch(self, points):
+        """
+        Converts an array of points in nanometers to micrometer pixel coordinates.
+
+        Args:
+            points (array_like): An (N, 2) array of x and y coordinates in nanometers.
+
+        Returns:
+            numpy.ndarray: An (N, 2) array of x and y coordinates in micrometer pixel units.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        affine2d = None
+        if self._use_numba and len(points) >= _NUMBA_MIN_POINTS:
+            affine2d = _get_affine2d()
+        if affine2d is not None:
+            out = np.empty_like(points)
+            affine2d(np.ascontiguousarray(points), self._sx, self._sy, self._bx, self._by, out)
+            return out
+        return points * self._scale + self._bias
+
+
+    def _iter_ndpviewstates(self):
+        """
+        Yields the view state elements of the NDPA file as they are parsed.
+
+        Each element is cleared and detached from the tree once the caller is done
+        with it, so only one view state is held in memory at a time.
+        """
+        if _LXML:
+            # lxml filters the events by tag without calling back into Python
+            context = ET.iterparse(self.ndpa_path, events=('end',), tag='ndpviewstate')
+            for _, element in context:
+                yield element
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            return
+
+        context = ET.iterparse(self.ndpa_path, events=('start', 'end'))
+        _, root = next(context)
+        for event, element in context:
+            if event != 'end' or element.tag != 'ndpviewstate':
+                continue
+            yield element
+            element.clear()
+            root.remove(element)
 
 
     def _parse_annotations(self):
         """
         Parses annotations from the NDPA file.
+
+        The parsed annotations are cached on disk (see _annotation_cache_dir),
+        keyed by both the NDPA and the NDPI file since the pixel coordinates
+        depend on the slide metadata.
         """
-        self.xml_root = ET.parse(self.ndpa_path).getroot()
+        cache_path = None
+        if self._annotation_cache_dir is not None:
+            cache_path = _cache_path(self._annotation_cache_dir, "annotations", self.ndpi_path, self.ndpa_path)
+            signature = _cache_signature(self.ndpi_path, self.ndpa_path)
+            cached = _load_cache(cache_path, signature)
+            if cached is not None:
+                self.annotations = [Annotation(*values) for values in cached['annotations']]
+                for name in self._annotation_arrays:
+                    setattr(self, name, cached[name])
+                self._link_annotation_points()
+                return
+
         self.annotations = []
+        # numerical fields of all annotations, kept as text and parsed by
+        # NumPy one field at a time once all view states have been read
+        lenses = []
+        zs = []
+        radii = []
+        # coordinates (in nm) of all annotations, converted together at the end
+        centres = []
+        nm_points = []
+        point_counts = []
 
-        for ndpviewstate_element in self.xml_root.findall('ndpviewstate'):
-            
-            # parse view state details
-            annotation = SimpleNamespace(xml_type='ndpviewstate')
-            annotation.title = ndpviewstate_element.find('title').text
-            details = ndpviewstate_element.find('details').text
-            annotation.details = details if details else ""
-            annotation.coordformat = ndpviewstate_element.find('coordformat').text
-            annotation.lens = float(ndpviewstate_element.find('lens').text)
-            annotation.showtitle = ndpviewstate_element.find('showtitle').text=="1"
-            annotation.showhistogram = ndpviewstate_element.find('showhistogram').text=="1"
-            annotation.showlineprofile = ndpviewstate_element.find('showlineprofile').text=="1"
+        for ndpviewstate_element in self._iter_ndpviewstates():
             
+            # look up the children once instead of scanning for each field
+            view_state = {child.tag: child for child in ndpviewstate_element}
+
             # parse annotation for this view state
             # it's flatten into the same level as the view state
-            annotation_element = ndpviewstate_element.find('annotation')
-            annotation.type = annotation_element.attrib['type']
-            annotation.displayname = annotation_element.attrib['displayname']
-            annotation.color = annotation_element.attrib['color']
-            annotation.measuretype = annotation_element.find('measuretype').text
-            annotation.closed = annotation_element.find('closed').text=="1"
+            annotation_element = view_state['annotation']
+            annotation_type = annotation_element.attrib['type']
+            # linearmeasure keeps its two points in the view state, so only
+            # the other types need their point list
+            is_linearmeasure = annotation_type == "linearmeasure"
+            measuretype = None
+            closed = False
+            points = []
+            
+            # single pass over the annotation children
+            for child in annotation_element:
+                tag = child.tag
+                if tag == 'measuretype':
+                    measuretype = _intern(child.text)
+                elif tag == 'closed':
+                    closed = _flag(child)
+                elif tag == 'pointlist' and not is_linearmeasure:
+                    # the <x> and <y> of each point are taken by position
+                    for p in child:
+                        points.append(p[0].text)
+                        points.append(p[1].text)
             
-            if annotation.type == "linearmeasure":
-                x1= float(ndpviewstate_element.find('x1').text)
-                x2= float(ndpviewstate_element.find('x2').text)
-                y1= float(ndpviewstate_element.find('y1').text)
-                y2= float(ndpviewstate_element.find('y2').text)
+            # the enum-like strings come from a small vocabulary, intern them
+            # so all the annotations share the same string objects
+            details = view_state['details'].text
+            annotation = Annotation(
+                title=view_state['title'].text,
+                details=details if details else "",
+                coordformat=_intern(view_state['coordformat'].text),
+                showtitle=_flag(view_state.get('showtitle')),
+                showhistogram=_flag(view_state.get('showhistogram')),
+                showlineprofile=_flag(view_state.get('showlineprofile')),
+                type=sys.intern(annotation_type),
+                displayname=sys.intern(annotation_element.attrib['displayname']),
+                color=sys.intern(annotation_element.attrib['color']),
+                measuretype=measuretype,
+                closed=closed,
+            )
+            lenses.append(view_state['lens'].text)
+
+            if is_linearmeasure:
                 # linearmeasure
-                annotation.points = [
-                    [self.nm_to_pixel([x1,y1])],
-                    [self.nm_to_pixel([x2,y2])],
+                centres += [np.nan, np.nan]
+                zs.append(np.nan)
+                points = [
+                    view_state['x1'].text, view_state['y1'].text,
+                    view_state['x2'].text, view_state['y2'].text,
                 ]
             else:
                 # all others have x,y,z coords
-                annotation.x = float(ndpviewstate_element.find('x').text)
-                annotation.y = float(ndpviewstate_element.find('y').text)
-                # convert
-                annotation.x, annotation.y = self.nm_to_pixel([annotation.x,annotation.y])
-                annotation.z = float(ndpviewstate_element.find('z').text)
-                # circle type annotation
-                radius = ndpviewstate_element.find('radius')
-                if radius:
-                    annotation.radius = float(radius.text)
-                # all other annotation types
-                points = annotation_element.findall('pointlist/point')
-                if points:
-                    annotation.points = [[float(p.find('x').text),float(p.find('y').text)] for p in points]
-                    annotation.points = [self.nm_to_pixel(p) for p in annotation.points]
+                centres += [view_state['x'].text, view_state['y'].text]
+                zs.append(view_state['z'].text)
+
+            # circle type annotation
+            radius = view_state.get('radius')
+            radii.append(radius.text if radius is not None else np.nan)
 
+            nm_points.extend(points)
+            point_counts.append(len(points) // 2)
             self.annotations.append(annotation)
+
+        self.lenses = np.array(lenses, dtype=np.float64)
+        self.zs = np.array(zs, dtype=np.float64)
+        self.radii = np.array(radii, dtype=np.float64)
+        self.closed_mask = np.array([annotation.closed for annotation in self.annotations], dtype=bool)
+
+        # convert all coordinates to pixels in a single vectorized operation
+        # the centres hold NaNs for linear measures, so they always take the NumPy path
+        centres = np.array(centres, dtype=np.float64).reshape(-1, 2) * self._scale + self._bias
+        self.xs, self.ys = np.ascontiguousarray(centres.T)
+        self.points_flat = self.nm_to_pixel_batch(np.array(nm_points, dtype=np.float64).reshape(-1, 2))
+        self.points_offsets = np.zeros(len(point_counts) + 1, dtype=np.intp)
+        np.cumsum(point_counts, out=self.points_offsets[1:])
+
+        # the annotations hold their numerical fields as python floats
+        lenses, radii = self.lenses.tolist(), self.radii.tolist()
+        xs, ys, zs = self.xs.tolist(), self.ys.tolist(), self.zs.tolist()
+        for i, annotation in enumerate(self.annotations):
+            annotation.lens = lenses[i]
+            if annotation.type != "linearmeasure":
+                annotation.x, annotation.y, annotation.z = xs[i], ys[i], zs[i]
+            if not math.isnan(radii[i]):
+                annotation.radius = radii[i]
+
+        # cache before the points are linked, so points_flat is stored only once
+        # only plain data is pickled, so the cache doesn't depend on the
+        # module path of the Annotation class
+        if cache_path is not None:
+            names = [field.name for field in fields(Annotation)]
+            cached = {name: getattr(self, name) for name in self._annotation_arrays}
+            cached['annotations'] = [
+                tuple(getattr(annotation, name) for name in names) for annotation in self.annotations
+            ]
+            _dump_cache(cache_path, signature, cached)
+        self._link_annotation_points()
+
+
+    def _link_annotation_points(self):
+        """
+        Sets the points of each annotation from points_flat.
+
+        The annotations get plain lists of [x, y] points, as they always had;
+        points_flat and points_offsets are there for bulk array access.
+        """
+        offsets = self.points_offsets.tolist()
+        for i, annotation in enumerate(self.annotations):
+            if offsets[i] != offsets[i+1]:
+                annotation.points = self.points_flat[offsets[i]:offsets[i+1]].tolist()